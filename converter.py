@@ -0,0 +1,337 @@
+"""
+Core QGIS GeoJSON -> DJI WPML (KMZ) conversion.
+Rebuilds the waypoints of a DJI Pilot 2 seed KMZ in both template.kml and
+waylines.wpml. The Streamlit UI in app.py calls convert().
+"""
+import zipfile, io, copy, shutil, functools, json
+import ijson
+import numpy as np
+from lxml import etree as ET
+
+# --- Constants and Namespace Setup ---
+KML_URI = "http://www.opengis.net/kml/2.2"
+# lxml keeps the seed's own namespace prefixes on output, so the default KML
+# namespace needs no registration.
+
+# Seed files are user uploads: never resolve entities or touch the network.
+# Nothing looks elements up by xml:id, so the parser skips building that index.
+XML_PARSER = ET.XMLParser(resolve_entities=False, no_network=True, collect_ids=False)
+
+# XPaths that only involve the KML namespace are compiled once at import time.
+_KML = {"kml": KML_URI}
+FIND_FOLDERS = ET.XPath(".//kml:Document/kml:Folder", namespaces=_KML)
+FIND_POINT_PMS = ET.XPath("kml:Placemark[kml:Point]", namespaces=_KML)
+FIND_WAYPOINT_COORDS = ET.XPath("kml:Placemark/kml:Point/kml:coordinates", namespaces=_KML)
+FIND_LINESTRING_COORDS = ET.XPath(".//kml:LineString/kml:coordinates", namespaces=_KML)
+
+# KMZ members are small XML files; level 5 deflates them almost as tightly as
+# the default level 6 for noticeably less CPU.
+KMZ_COMPRESSLEVEL = 5
+COPY_CHUNK_SIZE = 64 * 1024
+
+# --- Utility Functions ---
+
+def detect_wpml_uri(root):
+    """
+    Finds the WPML namespace URI of a parsed seed file.
+    DJI declares it on the root element, so root.nsmap normally answers straight
+    away; otherwise the element tags are searched.
+    """
+    for uri in root.nsmap.values():
+        if "wpmz" in uri:
+            return uri
+    for el in root.iter(ET.Element): # elements only, no comments or PIs
+        if el.tag.startswith("{") and "wpmz" in el.tag:
+            return el.tag[1:].split("}", 1)[0]
+    raise RuntimeError("Could not detect WPML namespace in the seed file.")
+
+def NS(wpml_uri):
+    """Returns the namespace map for searches."""
+    return {"kml": KML_URI, "wpml": wpml_uri}
+
+@functools.lru_cache(maxsize=8) # the URI comes from the upload, so keep the cache bounded
+def wpml_xpaths(wpml_uri):
+    """
+    Compiles the WPML lookups once per namespace URI and returns
+    (find_execute_height, find_index).
+    """
+    ns = NS(wpml_uri)
+    return (
+        ET.XPath("wpml:executeHeight", namespaces=ns),
+        ET.XPath("wpml:index", namespaces=ns),
+    )
+
+def is_waypoint_count_tag(tag):
+    """True for tags like wpml:waypointNum that hold the number of waypoints."""
+    local = tag.split("}", 1)[-1].lower()
+    return "waypoint" in local and ("num" in local or "count" in local)
+
+def points_from_geojson(file, default_alt=30.0, altitude_override=None):
+    """
+    Extracts an (N, 3) float64 array of lon, lat, alt rows from a GeoJSON file.
+    Features are streamed one at a time, so the whole collection is never held in memory.
+    With altitude_override set, every row gets that altitude and alt_m is never read.
+    """
+    default_alt = float(default_alt)
+    read_alt = altitude_override is None
+    lons, lats, alts = [], [], []
+    try:
+        for f in ijson.items(file, "features.item", use_float=True):
+            if not isinstance(f, dict): # e.g. truncated input such as {"features": [1,
+                raise ConversionError("Invalid GeoJSON file.")
+            g = f.get("geometry") or {}
+            t = g.get("type")
+            if t == "Point" or (t and t.lower() == "point"): # spec spelling first, skips .lower()
+                lon, lat = g["coordinates"][:2]
+                lons.append(lon)
+                lats.append(lat)
+                if read_alt:
+                    alt = (f.get("properties") or {}).get("alt_m")
+                    alts.append(default_alt if alt is None else float(alt))
+    except ijson.JSONError:
+        raise ConversionError("Invalid GeoJSON file.") from None
+
+    pts = np.empty((len(lons), 3), dtype=np.float64)
+    pts[:, 0] = lons
+    pts[:, 1] = lats
+    pts[:, 2] = alts if read_alt else float(altitude_override)
+    return pts
+
+def new_member_info(item):
+    """
+    Returns a fresh, deflated ZipInfo carrying a seed member's name, timestamp
+    and attributes.
+    """
+    info = zipfile.ZipInfo(item.filename, date_time=item.date_time)
+    info.external_attr = item.external_attr
+    info.compress_type = zipfile.ZIP_DEFLATED
+    return info
+
+def copy_member(zin, zout, item):
+    """
+    Streams an untouched seed member into the output KMZ in 64 KiB chunks,
+    keeping the member's original compression method.
+    """
+    info = new_member_info(item)
+    info.compress_type = item.compress_type
+    info.file_size = item.file_size # lets zipfile decide up front whether ZIP64 is needed
+    with zin.open(item) as src, zout.open(info, "w") as dst:
+        shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+
+def find_route_folder(root, ns):
+    """Finds the most likely mission Folder in a KML/WPML document."""
+    candidates = FIND_FOLDERS(root)
+    if len(candidates) == 1: # the usual DJI layout, nothing to score
+        return candidates[0] if FIND_POINT_PMS(candidates[0]) else None
+
+    any_wpml = f"{{{ns['wpml']}}}*"
+    best = (0, None)
+    for f in candidates:
+        pts = FIND_POINT_PMS(f)
+        if pts: # A folder must contain points to be a candidate
+            score = len(pts)
+            if next(f.iter(any_wpml), None) is not None: # stops at the first WPML element
+                score += 100
+            if score > best[0]:
+                best = (score, f)
+    return best[1]
+
+# --- Seed Loading (cached per process) ---
+
+@functools.lru_cache(maxsize=4)
+def load_seed(seed_bytes):
+    """
+    Reads a seed KMZ's central directory once and returns
+    (infos, wpml_name, template_name, wpml_bytes, template_bytes).
+    Either name is None if the seed does not contain that file.
+    The result is shared between calls, so the ZipInfo objects must not be mutated.
+    """
+    with zipfile.ZipFile(io.BytesIO(seed_bytes), "r") as zin:
+        infos = tuple(zin.infolist())
+        # One pass that stops as soon as both mission files have been seen
+        wpml_name = template_name = None
+        for info in infos:
+            lower = info.filename.lower()
+            if wpml_name is None and lower.endswith("waylines.wpml"):
+                wpml_name = info.filename
+            elif template_name is None and lower.endswith("template.kml"):
+                template_name = info.filename
+            if wpml_name and template_name:
+                break
+        if not wpml_name or not template_name:
+            return infos, wpml_name, template_name, None, None
+        return infos, wpml_name, template_name, zin.read(wpml_name), zin.read(template_name)
+
+@functools.lru_cache(maxsize=8)
+def parse_seed_xml(xml_bytes):
+    """Parses a seed XML file once. The tree is shared, so deepcopy it before mutating."""
+    return ET.fromstring(xml_bytes, XML_PARSER)
+
+# --- Core Logic for Modifying KML/WPML ---
+
+def format_points(points):
+    """
+    Formats the waypoints once for both mission files and returns
+    (lonlat_texts, alt_texts, shared_alt_text): "lon,lat" at 7 decimals and
+    altitude at 2 decimals. shared_alt_text is the altitude text when every
+    waypoint has the same altitude, otherwise None.
+    """
+    # One %-format over all values is run by a single C call, then split back
+    # into per-waypoint texts. Plain Python floats format much faster than NumPy scalars.
+    n = len(points)
+    lonlat_texts = ("%.7f,%.7f\n" * n % tuple(points[:, :2].ravel().tolist())).splitlines()
+
+    alts = points[:, 2]
+    if n and (alts == alts[0]).all(): # e.g. the altitude override
+        shared_alt_text = f"{alts[0]:.2f}"
+        alt_texts = [shared_alt_text] * n
+    else:
+        shared_alt_text = None
+        alt_texts = ("%.2f\n" * n % tuple(alts.tolist())).splitlines()
+    return lonlat_texts, alt_texts, shared_alt_text
+
+def update_mission_file(root, texts, ns, is_template_kml):
+    """
+    The core logic for updating a KML/WPML file tree.
+    This function modifies the XML root in-place.
+    `texts` is the (lonlat_texts, alt_texts, shared_alt_text) result of format_points().
+    """
+    lonlat_texts, alt_texts, shared_alt_text = texts
+    folder = find_route_folder(root, ns)
+    if folder is None:
+        raise RuntimeError(f"Could not find a valid route Folder in {'template.kml' if is_template_kml else 'waylines.wpml'}.")
+
+    pms = FIND_POINT_PMS(folder)
+    if not pms:
+        raise RuntimeError(f"The route folder in {'template.kml' if is_template_kml else 'waylines.wpml'} contains no Point placemarks to use as a template.")
+
+    template_pm = pms[-1]
+
+    # Clear existing waypoints
+    for pm in pms:
+        folder.remove(pm)
+
+    # Build the new waypoints from the template, then attach them in one go.
+    # The loop-invariant callables are bound to locals once.
+    deepcopy = copy.deepcopy
+    find_execute_height, find_index = wpml_xpaths(ns["wpml"])
+    clones = []
+    append = clones.append
+    for i, alt_text in enumerate(alt_texts):
+        clone = deepcopy(template_pm)
+
+        # waylines.wpml carries the altitude separately from its 2D coordinates
+        if not is_template_kml:
+            eh_els = find_execute_height(clone)
+            if eh_els:
+                eh_els[0].text = alt_text
+
+        # **CRITICAL FIX**: Re-index for BOTH file types.
+        # DJI uses 0-based index in waylines.wpml and 1-based in template.kml
+        index_els = find_index(clone)
+        if index_els:
+            index_els[0].text = str(i if not is_template_kml else i + 1)
+
+        append(clone)
+
+    folder.extend(clones)
+
+    # template.kml uses 3D coordinates, waylines.wpml 2D ones; the texts are
+    # reused for the LineString below.
+    if is_template_kml:
+        if shared_alt_text is not None:
+            suffix = "," + shared_alt_text
+            coord_texts = [lonlat + suffix for lonlat in lonlat_texts]
+        else:
+            coord_texts = [f"{lonlat},{alt}" for lonlat, alt in zip(lonlat_texts, alt_texts)]
+    else: # waylines.wpml
+        coord_texts = lonlat_texts
+
+    # The old waypoints are gone, so one query returns the new coordinates in order
+    for coords_el, text in zip(FIND_WAYPOINT_COORDS(folder), coord_texts):
+        coords_el.text = text
+
+    # Update the LineString that visualizes the path
+    ls_coords = FIND_LINESTRING_COORDS(folder)
+    if ls_coords:
+        ls_coords_el = ls_coords[0]
+        if is_template_kml:
+            ls_coords_el.text = " ".join(coord_texts)
+        else: # waylines.wpml often has no altitude in its linestring
+            ls_coords_el.text = ",0 ".join(coord_texts) + ",0"
+
+    # Update waypoint count in waylines.wpml
+    if not is_template_kml:
+        # A mission repeats the same few dozen WPML tags, so each distinct tag
+        # is checked once. The dict lives only for this call because the tags
+        # come from the upload.
+        count_text = str(len(lonlat_texts))
+        count_tags = {}
+        for el in folder.iter(f"{{{ns['wpml']}}}*"):
+            tag = el.tag
+            is_count = count_tags.get(tag)
+            if is_count is None:
+                is_count = count_tags[tag] = is_waypoint_count_tag(tag)
+            if is_count:
+                el.text = count_text
+
+
+# --- KMZ Conversion ---
+
+class ConversionError(Exception):
+    """A problem with the uploaded files, shown to the user as a plain error message."""
+
+def convert(seed_bytes, pts_bytes, override_alt, alt_value):
+    """
+    Rebuilds the seed KMZ around the GeoJSON waypoints and returns (kmz_bytes, n_points).
+    This is the single entry point the UI calls; it has no Streamlit dependency.
+    """
+    infos, wpml_name, template_name, wpml_bytes, template_bytes = load_seed(seed_bytes)
+    if not wpml_name or not template_name:
+        raise ConversionError("Seed KMZ must contain both 'template.kml' and 'waylines.wpml'.")
+
+    # The parsed seed trees are cached, so work on private copies.
+    wpml_root = copy.deepcopy(parse_seed_xml(wpml_bytes))
+    template_root = copy.deepcopy(parse_seed_xml(template_bytes))
+
+    wpml_uri = detect_wpml_uri(wpml_root)
+    ns = NS(wpml_uri)
+
+    # ijson only reads UTF-8; like json.load, accept a BOM and UTF-16/32 uploads
+    encoding = json.detect_encoding(pts_bytes)
+    if encoding != "utf-8":
+        try:
+            pts_bytes = pts_bytes.decode(encoding).encode("utf-8")
+        except UnicodeError:
+            raise ConversionError("Invalid GeoJSON file.") from None
+
+    points = points_from_geojson(
+        io.BytesIO(pts_bytes),
+        default_alt=alt_value,
+        altitude_override=alt_value if override_alt else None,
+    )
+    if len(points) < 2:
+        raise ConversionError("GeoJSON must contain at least 2 Point features.")
+    if len(points) > 1000:  # DJI missions rarely need more than 1000 waypoints
+        raise ConversionError("Too many waypoints. Maximum supported is 1000 points.")
+
+    # --- UPDATE BOTH FILES ---
+    texts = format_points(points)
+    update_mission_file(template_root, texts, ns, is_template_kml=True)
+    update_mission_file(wpml_root, texts, ns, is_template_kml=False)
+
+    # --- REPACK THE KMZ ---
+    buf = io.BytesIO()
+    with zipfile.ZipFile(io.BytesIO(seed_bytes), "r") as zin, \
+         zipfile.ZipFile(buf, "w") as zout:
+        for item in infos:
+            if item.filename == template_name:
+                data = ET.tostring(template_root, encoding="utf-8", xml_declaration=True)
+            elif item.filename == wpml_name:
+                data = ET.tostring(wpml_root, encoding="utf-8", xml_declaration=True)
+            else:
+                copy_member(zin, zout, item)
+                continue
+            zout.writestr(new_member_info(item), data, compresslevel=KMZ_COMPRESSLEVEL)
+
+    return buf.getvalue(), len(points)